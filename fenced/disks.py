@@ -1,5 +1,10 @@
+import collections
+import itertools
 import logging
-from concurrent.futures import ThreadPoolExecutor, wait as fut_wait
+import operator
+import os
+import typing
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutTimeoutError, as_completed
 
 from middlewared.utils.scsi_generic import inquiry
 
@@ -7,21 +12,63 @@ from libsgio import SCSIErrorException, SCSI_OPCODES, SCSIDevice as SCSI
 from nvme import NvmeDevice as NVME
 
 SET_DISKS_CAP = 30
+# SCSI/NVMe PR commands are I/O bound and independent per device so there is
+# no reason to serialize them in waves of `SET_DISKS_CAP`. Threads are only
+# spawned on demand so this is an upper bound, not a preallocation.
+MAX_IO_WORKERS = 128
 logger = logging.getLogger(__name__)
 
 
+class RecoverResult(typing.NamedTuple):
+    failed: set  # disks that could not be recovered
+    preempted: set  # disks whose reservation is held by another host
+
+
 class Disks(dict):
 
     def __init__(self, fence):
         self.fence = fence
-        self._set_disks = set()
+        self._rotation = collections.deque()
+        self._executor = None
+        # worker threads do not survive a fork() so make sure the daemonized
+        # child spins up its own pool instead of queueing work forever on the
+        # (now dead) threads it inherited from the parent
+        os.register_at_fork(after_in_child=self._forget_executor)
 
     def add(self, disk):
         assert isinstance(disk, Disk)
+        if (old := self.get(disk.name)) is not None:
+            self._rotation.remove(old)
         self[disk.name] = disk
+        self._rotation.append(disk)
 
     def remove(self, disk):
-        self.pop(disk.name)
+        self._rotation.remove(self.pop(disk.name))
+
+    def clear(self):
+        super().clear()
+        self._rotation.clear()
+
+    @property
+    def executor(self):
+        """
+        The thread pool is kept for the lifetime of this object so that
+        we don't pay for spawning (and tearing down) threads on every single
+        round. `SET_DISKS_CAP` caps how many disks get a new key per round,
+        not how many disks we talk to concurrently (`get_keys` and
+        `reset_keys` run against all of them).
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=MAX_IO_WORKERS, thread_name_prefix='fenced')
+        return self._executor
+
+    def _forget_executor(self):
+        self._executor = None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
 
     def _get_set_disks(self):
         """
@@ -29,57 +76,109 @@ class Disks(dict):
         hundreds of them.
         For better performance let's cap the number of disks we set the new key
         per round to `SET_DISKS_CAP`.
+        We walk the disks round-robin so that every disk gets its key
+        updated every `len(self) / SET_DISKS_CAP` rounds.
         """
         if len(self) <= SET_DISKS_CAP:
             return self.values()
 
-        newset = set(self.values()) - self._set_disks
-        if newset:
-            if len(newset) > SET_DISKS_CAP:
-                newset = set(list(newset)[:SET_DISKS_CAP])
-                self._set_disks.update(newset)
-            else:
-                newset.update(set(
-                    list(
-                        self.values()
-                    )[:SET_DISKS_CAP - len(newset)]
-                ))
-                self._set_disks = newset
-            return newset
-        else:
-            self._set_disks = set(list(self.values())[:SET_DISKS_CAP])
-            return self._set_disks
+        disks = list(itertools.islice(self._rotation, SET_DISKS_CAP))
+        self._rotation.rotate(-SET_DISKS_CAP)
+        return disks
+
+    def _abandon(self, executor, pending):
+        """
+        Stop waiting on the `pending` futures of a batch run on `executor`.
+        """
+        # don't leave the stale work queued up in front of the next batch
+        for i in pending:
+            i.cancel()
+        # cancel() also fails for futures that finished in the meantime,
+        # only the ones still running actually hold on to a worker
+        running = [i for i in pending if i.running()]
+        if running and self._executor is executor:
+            # these may well be stuck in a SCSI/NVMe command, retire the
+            # pool so the next batch gets fresh workers
+            logger.warning('Retiring thread pool with %d outstanding command(s)', len(running))
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
 
     def _run_batch(self, method, args=None, disks=None, done_callback=None):
         """
         Helper method to run a batch of a Disk method
+        `done_callback` may return True to stop the batch right away, the
+        disks that haven't finished by then are counted as failed.
         """
         args = args or []
         disks = disks or self.values()
-        executor = ThreadPoolExecutor(max_workers=SET_DISKS_CAP)
+        call = operator.methodcaller(method, *args)
+        executor = self.executor
+        fs = {executor.submit(call, disk): disk for disk in disks}
+        failed = set()
+        pending = set(fs)
         try:
-            fs = {
-                executor.submit(getattr(disk, method), *args): disk
-                for disk in disks
-            }
-            done_notdone = fut_wait(fs.keys(), timeout=30)
-        finally:
-            executor.shutdown(wait=False)
-        failed = {fs[i] for i in done_notdone.not_done}
-        if failed:
-            logger.warning('method %r with args %r timed out for %d disk(s)', method, args, len(failed))
-        for i in done_notdone.done:
-            if done_callback:
-                done_callback(i, fs, failed)
-            else:
-                try:
-                    i.result()
-                except Exception:
-                    disk = fs[i]
-                    logger.warning('method %r with args %r for disk %r failed.', method, args, disk, exc_info=True)
-                    failed.add(disk)
+            # handle the results as they come in rather than waiting on the
+            # slowest disk before doing anything with them
+            for i in as_completed(fs, timeout=30):
+                pending.discard(i)
+                if done_callback:
+                    if done_callback(i, fs, failed):
+                        if pending:
+                            failed.update(fs[i] for i in pending)
+                            self._abandon(executor, pending)
+                        break
+                else:
+                    try:
+                        i.result()
+                    except Exception:
+                        disk = fs[i]
+                        logger.warning('method %r with args %r for disk %r failed.', method, args, disk, exc_info=True)
+                        failed.add(disk)
+        except FutTimeoutError:
+            logger.warning('method %r with args %r timed out for %d disk(s)', method, args, len(pending))
+            failed.update(fs[i] for i in pending)
+            self._abandon(executor, pending)
         return failed
 
+    def _probe_disk(self, name, log_info):
+        # try 2 times to read the keys since there are SSDs
+        # that have a firmware bug that will actually barf
+        # on this request. However, nothing is wrong with
+        # the disk. If you simply send the same request
+        # again after this error, it will return the data
+        # requested with no errors.
+        # (i'm looking at you STEC ZeusRAM)
+        tries = 2
+        for i in range(tries):
+            try:
+                disk = Disk(self.fence, name, log_info=log_info)
+                return disk, disk.get_keys()[1]
+            except Exception:
+                if i < tries - 1:
+                    logger.warning('Retrying to read keys for disk %r', name)
+
+        return None, set()
+
+    def probe(self, disks):
+        """
+        Create a `Disk` for every entry in `disks` (name -> log info) and
+        read its keys. Each of those is a SCSI round-trip so they're run
+        on the thread pool instead of one disk at a time. The disks are
+        added on the calling thread.
+        Returns the remote keys found and the names of the disks that don't
+        support persistent reservations.
+        """
+        remote_keys = set()
+        unsupported = []
+        results = self.executor.map(self._probe_disk, disks.keys(), disks.values())
+        for name, (disk, keys) in zip(disks, results):
+            if disk is None:
+                unsupported.append(name)
+            else:
+                remote_keys.update(keys)
+                self.add(disk)
+        return remote_keys, unsupported
+
     def get_keys(self):
         keys = set()
         remote_keys = set()
@@ -98,20 +197,54 @@ class Disks(dict):
         failed = self._run_batch('get_keys', done_callback=callback)
         return keys, remote_keys, failed
 
+    def full_key(self, newkey):
+        """
+        Compose the 64bit reservation key (host id in the upper 4 bytes).
+        This is the same for every disk so it's done once per batch.
+        """
+        return self.fence.hostid << 32 | (newkey & 0xffffffff)
+
     def register_keys(self, newkey):
-        return self._run_batch('register_key', [newkey], disks=self._get_set_disks())
+        return self._run_batch('register_key', [self.full_key(newkey)], disks=self._get_set_disks())
+
+    def reset_keys(self, newkey, keys_known=False):
+        return self._run_batch('reset_keys', [self.full_key(newkey), keys_known])
+
+    def recover_keys(self, newkey, disks):
+        """
+        Try to reset the reservation on `disks` (normally the ones that failed
+        in `register_keys`).
+        Returns a `RecoverResult`.
+        """
+        preempted = set()
+        if not disks:
+            return RecoverResult(set(), preempted)
 
-    def reset_keys(self, newkey):
-        return self._run_batch('reset_keys', [newkey])
+        def callback(i, fs, failed):
+            try:
+                if not i.result():
+                    # we're going to panic, stop touching the other disks
+                    preempted.add(fs[i])
+                    return True
+            except Exception:
+                # already logged by `Disk.recover_key`
+                failed.add(fs[i])
+
+        failed = self._run_batch('recover_key', [self.full_key(newkey)], disks=disks, done_callback=callback)
+        return RecoverResult(failed, preempted)
 
 
 class Disk(object):
 
+    __slots__ = ('fence', 'name', 'log_info', 'curkey', 'has_keys', 'disk')
+
     def __init__(self, fence, name, log_info=None):
         self.fence = fence
         self.name = name
         self.log_info = log_info
         self.curkey = None
+        # whether the last `get_keys` found any keys on the disk
+        self.has_keys = False
         self.disk = self.__parse_disk(f'/dev/{name}')
 
     def __repr__(self):
@@ -134,27 +267,58 @@ class Disk(object):
             return SCSI(disk)
 
     def get_keys(self):
+        hostid = self.fence.hostid
         host_key = None
         remote_keys = set()
-        for key in self.disk.read_keys()['keys']:
+        keys = self.disk.read_keys()['keys']
+        for key in keys:
             # First 4 bytes are the host id
-            if key >> 32 == self.fence.hostid:
+            if key >> 32 == hostid:
                 host_key = key
             else:
                 remote_keys.add(key)
+        self.has_keys = bool(keys)
         return (host_key, remote_keys)
 
     def get_reservation(self):
         return self.disk.read_reservation()
 
     def register_key(self, newkey):
-        newkey = self.fence.hostid << 32 | (newkey & 0xffffffff)
+        """`newkey` is the full key as returned by `Disks.full_key`"""
         self.disk.update_key(self.curkey, newkey)
         self.curkey = newkey
 
-    def reset_keys(self, newkey):
+    def recover_key(self, newkey):
+        """
+        Returns False if the reservation on the disk has been preempted by
+        another host, otherwise resets the reservation with `newkey`
+        and returns True.
+        """
+        try:
+            resv = self.get_reservation()
+        except Exception:
+            logger.warning('Failed to get current reservation on %r', self.name, exc_info=True)
+            raise
+
+        if all((resv, resv['reservation'])) and self.fence.hostid != (resv['reservation'] >> 32):
+            return False
+
+        # getting here means we need to try and reset the reservations on the disk
+        logger.warning('Trying to reset reservation for %r', self.name)
+        try:
+            self.reset_keys(newkey)
+        except Exception:
+            logger.warning('Failed to reset reservation on %r', self.name, exc_info=True)
+            raise
+        return True
+
+    def reset_keys(self, newkey, keys_known=False):
+        """
+        `newkey` is the full key as returned by `Disks.full_key`
+        `keys_known`: the caller just ran `get_keys` on this disk so, if it
+            found keys, there is no need to read them again.
+        """
         reservation = self.get_reservation()
-        newkey = self.fence.hostid << 32 | (newkey & 0xffffffff)
         if reservation['reservation'] is not None:
             if reservation['reservation'] >> 32 != self.fence.hostid:
                 # reservation isn't ours so register new key
@@ -177,7 +341,7 @@ class Disk(object):
                 # reservation is owned by us so simply update
                 # the existing reservation with the new key
                 self.disk.update_key(reservation['reservation'], newkey)
-        elif not self.disk.read_keys()['keys']:
+        elif not (keys_known and self.has_keys) and not self.disk.read_keys()['keys']:
             # check to see if there are even keys on disk
             self.disk.register_new_key(newkey)
             self.disk.reserve_key(newkey)
@@ -4,7 +4,7 @@ import sys
 import time
 import signal
 
-from fenced.disks import Disk, Disks
+from fenced.disks import Disks
 from fenced.exceptions import PanicExit, ExcludeDisksError
 from fenced.utils import load_disks_impl
 
@@ -26,7 +26,7 @@ class Fence(object):
 
     def __init__(self, interval, exclude_disks, use_zpools):
         self._interval = interval
-        self._exclude_disks = exclude_disks
+        self._exclude_disks = frozenset(exclude_disks)
         self._use_zpools = use_zpools
         self._disks = Disks(self)
         self._reload = False
@@ -34,7 +34,9 @@ class Fence(object):
 
     def get_hostid(self):
         try:
-            with open(ID_FILE) as f:
+            # int() parses the hex digits straight from bytes, no need to
+            # go through the text layer
+            with open(ID_FILE, 'rb') as f:
                 return int(f.read(8), 16)
         except Exception:
             logger.error('failed to generate unique id', exc_info=True)
@@ -51,31 +53,10 @@ class Fence(object):
             logger.error('unhandled exception enumerating disk info', exc_info=True)
             sys.exit(ExitCode.UNKNOWN.value[0])
         else:
-            if disks and not set(disks) - set(self._exclude_disks):
+            if disks and not disks.keys() - self._exclude_disks:
                 raise ExcludeDisksError('Excluding all disks is not allowed')
 
-        unsupported = []
-        remote_keys = set()
-        for disk_name, disk_info in disks.items():
-            # try 2 times to read the keys since there are SSDs
-            # that have a firmware bug that will actually barf
-            # on this request. However, nothing is wrong with
-            # the disk. If you simply send the same request
-            # again after this error, it will return the data
-            # requested with no errors.
-            # (i'm looking at you STEC ZeusRAM)
-            tries = 2
-            for i in range(tries):
-                try:
-                    disk = Disk(self, disk_name, log_info=disk_info)
-                    remote_keys.update(disk.get_keys()[1])
-                except Exception:
-                    logger.warning('Retrying to read keys for disk %r', disk_name)
-                    if i < tries - 1:
-                        continue
-                    else:
-                        unsupported.append(disk_name)
-            self._disks.add(disk)
+        remote_keys, unsupported = self._disks.probe(disks)
 
         if unsupported:
             logger.warning('Disks without support for SCSI-3 PR: %s', ','.join(unsupported))
@@ -110,7 +91,9 @@ class Fence(object):
                 logger.info('Reservation keys unchanged.')
 
         newkey = int(time.time()) & 0xffffffff
-        failed_disks = self._disks.reset_keys(newkey)
+        # the keys were read either by `load_disks` or by the verification
+        # above, no reason to read them all again
+        failed_disks = self._disks.reset_keys(newkey, keys_known=True)
         if failed_disks:
             rate = int((len(failed_disks) / len(self._disks)) * 100)
             if rate > 10:
@@ -123,38 +106,38 @@ class Fence(object):
 
         return newkey
 
+    def close(self):
+        self._disks.close()
+
     def log_info(self):
-        logger.info(', '.join([f'{v.name}: {v.log_info}' for v in self._disks.values()]))
+        logger.info('%s', ', '.join(f'{v.name}: {v.log_info}' for v in self._disks.values()))
 
     def loop(self, key):
+        deadline = time.monotonic()
         while True:
             if self._reload:
                 logger.info('SIGHUP received, reloading.')
                 key = self.init(True)
                 self._reload = False
 
-            key = 2 if key > 0xffffffff else key + 1
+            # only the lower 4 bytes make it into the key, start over at 2 on wrap
+            key = (key + 1) & 0xffffffff or 2
             logger.debug('Setting new key: 0x%x', key)
-            for failed_disk in list(self._disks.register_keys(key)):
-                try:
-                    resv = failed_disk.get_reservation()
-                except Exception:
-                    logger.warning('Failed to get current reservation on %r', failed_disk.name, exc_info=True)
-                    self._disks.remove(failed_disk)
-                    continue
-                else:
-                    if all((resv, resv['reservation'])) and self.hostid != (resv['reservation'] >> 32):
-                        err = f'Reservation on {failed_disk.name!r} preempted!'
-                        logger.warning(err)
-                        raise PanicExit(err)
-
-                # getting here means we need to try and reset the reservations on the disk
-                logger.warning('Trying to reset reservation for %r', failed_disk.name)
-                try:
-                    failed_disk.reset_keys(key)
-                except Exception:
-                    logger.warning('Failed to reset reservation on %r', failed_disk.name, exc_info=True)
-                    self._disks.remove(failed_disk)
-                    pass
-
-            time.sleep(self._interval)
+            result = self._disks.recover_keys(key, self._disks.register_keys(key))
+            if result.preempted:
+                err = f'Reservation on {", ".join(sorted(map(str, result.preempted)))} preempted!'
+                logger.warning(err)
+                raise PanicExit(err)
+
+            for failed_disk in result.failed:
+                self._disks.remove(failed_disk)
+
+            # sleep until the next round is due (rather than a flat interval
+            # after this one finished) so the time each round takes doesn't
+            # add up. If we fell behind, don't try to catch up, just start over.
+            deadline += self._interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()
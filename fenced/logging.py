@@ -1,9 +1,15 @@
+import atexit
 import logging
 import logging.config
 import logging.handlers
 import os
+import queue
+import sys
+import threading
 
 LOG_FILE = '/var/log/fenced.log'
+_listener = None
+FLUSH_TIMEOUT = 2  # seconds
 
 
 def ensure_logdir_exists():
@@ -17,6 +23,11 @@ def ensure_logdir_exists():
 
 def setup_logging(foreground):
     ensure_logdir_exists()
+    # none of our formatters use the thread/process fields so there's no
+    # reason to look them up for every single record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
     logging.config.dictConfig({
         'version': 1,
         'disable_existing_loggers': False,
@@ -32,8 +43,9 @@ def setup_logging(foreground):
                 'formatter': 'simple',
                 'level': 'INFO',
                 'filename': LOG_FILE,
-                'maxBytes': 1000000,  # 1MB size
-                'backupCount': '3',
+                'maxBytes': 10000000,  # 10MB size
+                'backupCount': 3,
+                'encoding': 'utf-8',
             },
             'console': {
                 'class': 'logging.StreamHandler',
@@ -50,3 +62,96 @@ def setup_logging(foreground):
             },
         },
     })
+
+
+class LogListener(threading.Thread):
+    """
+    Hands the records put on `queue` by a `QueueHandler` to `handlers`,
+    honouring their levels.
+    This is pretty much `logging.handlers.QueueListener` but we need to be
+    able to give up on it (see `stop_log_listener`) and to know which handler
+    it's stuck in when that happens.
+    """
+
+    def __init__(self, queue, handlers):
+        super().__init__(name='fenced-log', daemon=True)
+        self.queue = queue
+        self.handlers = handlers
+        self.current = None
+
+    def run(self):
+        while (record := self.queue.get()) is not None:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    self.current = handler
+                    handler.handle(record)
+            self.current = None
+
+    def stop(self, timeout):
+        """
+        Returns False if the records queued up so far couldn't be written out
+        within `timeout` seconds.
+        """
+        self.queue.put(None)
+        self.join(timeout)
+        return not self.is_alive()
+
+
+def start_log_listener():
+    """
+    Hand the root logger's handlers over to a `LogListener` thread so that
+    `Fence.loop` never blocks on writing (or rotating) `LOG_FILE`, which is
+    exactly when it can't afford to fall behind on the reservations.
+    This must be called after we have fork()'ed since the listener thread
+    does not survive a fork.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    root = logging.getLogger()
+    handlers = root.handlers
+    with logging._lock:
+        # `logging.shutdown` (which runs at exit) flushes and closes every
+        # handler it knows about, holding the handler's lock. The listener
+        # thread owns these now and, if it's stuck in one of them, exiting
+        # would hang right along with it.
+        logging._handlerList[:] = [i for i in logging._handlerList if i() not in handlers]
+
+    q = queue.SimpleQueue()
+    qh = logging.handlers.QueueHandler(q)
+    # don't bother queueing records none of the handlers want
+    qh.setLevel(min(i.level for i in handlers))
+    _listener = LogListener(q, handlers)
+    root.handlers = [qh]
+    _listener.start()
+    atexit.register(stop_log_listener)
+
+
+def stop_log_listener(timeout=FLUSH_TIMEOUT):
+    """
+    Write out whatever is still queued and give the handlers back to the root
+    logger. Called at exit and right before we panic so the reason for the
+    panic actually makes it to `LOG_FILE`.
+    Waits at most `timeout` seconds: if `LOG_FILE` is hung we'd rather lose
+    the records than never get to the reboot.
+    """
+    global _listener
+    if _listener is None:
+        return
+
+    listener, _listener = _listener, None
+    if listener.stop(timeout):
+        handlers = listener.handlers
+    else:
+        # leave the handler the listener is stuck in alone, this includes
+        # keeping it away from `logging.shutdown`
+        handlers = [i for i in listener.handlers if i is not listener.current]
+
+    for handler in handlers:
+        logging._addHandlerRef(handler)
+    if not handlers:
+        handlers = [logging.StreamHandler(sys.stderr)]
+        handlers[0].setFormatter(listener.handlers[0].formatter)
+        handlers[0].setLevel(logging.INFO)
+    logging.getLogger().handlers = handlers
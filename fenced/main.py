@@ -7,45 +7,57 @@ import signal
 import sys
 import time
 import contextlib
+import fcntl
 import resource
 
 from fenced.exceptions import PanicExit, ExcludeDisksError
 from fenced.fence import Fence, ExitCode
-from fenced.logging import setup_logging
-from truenas_api_client import Client
+from fenced.logging import setup_logging, start_log_listener, stop_log_listener
 from middlewared.plugins.failover_.fenced import PID_FILE
 from middlewared.plugins.failover_.scheduled_reboot_alert import FENCED_ALERT_FILE
 
 logger = logging.getLogger(__name__)
+MIN_NOFILE = 4096
+MAX_NOFILE = 1 << 20  # default fs.nr_open
 
 
-def is_running():
+def lock_pid_file():
     """
-    Check if there is a currently running fenced process.
     Multiple fenced processes running on the same system will
     clobber one another and will, ultimately, cause a panic.
     Ticket #48031
-    Note: we need to make sure that if there is a running
-    fenced process, it's not ourself :)
+    Take an exclusive lock on `PID_FILE` instead of asking middlewared
+    whether fenced is running: it's atomic (no window between the check
+    and us starting) and it doesn't depend on middlewared being up.
+    The lock is tied to the open file so it follows the fd into the
+    daemonized child and is released when the process goes away.
+    Raises `BlockingIOError` if another fenced process holds the lock.
     """
-    running = False
-    with contextlib.suppress(Exception):
-        with Client() as c:
-            data = c.call('failover.fenced.run_info')
-            if data['running'] and data['pid']:
-                if data['pid'] != os.getpid():
-                    running = True
+    fd = os.open(PID_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except Exception:
+        os.close(fd)
+        raise
 
-    return running
+    return fd
 
 
-def update_pid_file():
+def update_pid_file(fd):
     """
     We call this method after we have fork()'ed
     """
     with contextlib.suppress(Exception):
-        with open(PID_FILE, 'w+') as f:
-            f.write(str(os.getpid()))
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(os.getpid()).encode(), 0)
+
+
+def write_proc(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CLOEXEC)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
 
 
 def panic(reason):
@@ -56,24 +68,27 @@ def panic(reason):
     and will send an appropriate email and then remove it.
     Ticket #39114
     """
+    # we're on our way to reboot the box so skip python's buffered (and
+    # encoding) I/O layer and issue the syscalls directly
     try:
-        with open(FENCED_ALERT_FILE, 'w') as f:
-            f.write(f'{time.time()}')
-            f.flush()
-            os.fsync(f.fileno())  # Be extra sure
+        fd = os.open(FENCED_ALERT_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        try:
+            os.write(fd, f'{time.time()}'.encode())
+            os.fdatasync(fd)  # Be extra sure
+        finally:
+            os.close(fd)
     except Exception:
         logger.warning('Failed to write alert file', exc_info=True)
 
     logger.critical('FATAL: issuing an immediate panic because %s', reason)
+    stop_log_listener()
 
     # enable the "magic" sysrq-triggers
     # https://www.kernel.org/doc/html/latest/admin-guide/sysrq.html
-    with open('/proc/sys/kernel/sysrq', 'w') as f:
-        f.write('1')
+    write_proc('/proc/sys/kernel/sysrq', b'1')
 
     # now violently reboot
-    with open('/proc/sysrq-trigger', 'w') as f:
-        f.write('b')
+    write_proc('/proc/sysrq-trigger', b'b')
 
 
 def set_resource_limits():
@@ -81,25 +96,41 @@ def set_resource_limits():
     On an M60 HA system with 12x ES102 JBODs, we have 1255 disks which
     means when fenced tries to open each disk, kernel shuts it down
     because we're opening more than RLIMIT_NOFILE (default 1024) so we
-    need to bump this to the hard limit (4096).
+    need to bump this. Use the hard limit the system gives us (never less
+    than 4096) rather than a hardcoded value so that even bigger
+    configurations keep working.
+    """
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = MAX_NOFILE
+    limit = max(hard, MIN_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, limit))  # soft and hard limits respectively
+
+
+def set_realtime_priority():
     """
-    limits = (4096, 4096)  # soft and hard limits respectively
-    resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+    If `Fence.loop` gets delayed past `2 * interval` (e.g. CPU starvation
+    on a busy controller) the remote controller may think we're gone and
+    take over the disks. Run under SCHED_FIFO, at a low RT priority, so
+    that we always get scheduled when a round is due.
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+    except Exception:
+        logger.warning('Failed to set realtime scheduling priority', exc_info=True)
 
-def parse_ed(value) -> tuple[str] | tuple:
+
+def parse_ed(value) -> frozenset[str]:
     """This method is used to parse the disks to be excluded
     from fenced. This is given to us by the caller exclusively.
     """
-    parsed = list()
     try:
-        for i in value.split():
-            for j in i.split(','):
-                if (j := j.strip()):
-                    parsed.append(j)
+        # disks may be separated by commas, whitespace or both
+        return frozenset(value.replace(',', ' ').split())
     except Exception:
         logger.error('Unexpected failure parsing exclude disks', exc_info=True)
 
-    return tuple(parsed)
+    return frozenset()
 
 
 def main():
@@ -132,6 +163,11 @@ def main():
         help='List of disks to be excluded from SCSI reservations.'
              ' (THIS CAN CAUSE PROBLEMS IF YOU DONT KNOW WHAT YOURE DOING)',
     )
+    parser.add_argument(
+        '--realtime', '-rt',
+        action='store_true',
+        help='Run the fencing loop with realtime (SCHED_FIFO) scheduling priority',
+    )
     parser.add_argument(
         '--use-zpools', '-uz',
         action='store_true',
@@ -141,12 +177,22 @@ def main():
 
     setup_logging(args.foreground)
 
-    if is_running():
+    try:
+        pid_fd = lock_pid_file()
+    except BlockingIOError:
         rc, err = ExitCode.ALREADY_RUNNING.value
         logger.error(err)
         sys.exit(rc)
+    except Exception:
+        logger.error('Failed to lock %r', PID_FILE, exc_info=True)
+        sys.exit(ExitCode.UNKNOWN.value[0])
 
     set_resource_limits()
+    if args.realtime:
+        # the policy is per thread and inherited by the threads (and the
+        # processes) we create, so set it before `Fence.init` spins up the
+        # I/O thread pool
+        set_realtime_priority()
     fence = Fence(args.interval, args.exclude_disks, args.use_zpools)
     newkey = fence.init(args.force)
 
@@ -157,11 +203,15 @@ def main():
         os.setsid()
         if os.fork() != 0:
             sys.exit(0)
+        # don't keep whatever directory we were started from busy
+        os.chdir('/')
+        os.umask(0o022)
         os.closerange(0, 3)
     else:
         logger.info('Running in foreground mode.')
 
-    update_pid_file()
+    start_log_listener()
+    update_pid_file(pid_fd)
 
     signal.signal(signal.SIGHUP, fence.signal_handler)
     signal.signal(signal.SIGUSR1, fence.signal_handler)
@@ -183,6 +233,8 @@ def main():
         rc, err = ExitCode.UNKNOWN.value
         logger.critical(err, exc_info=True)
         sys.exit(rc)
+    finally:
+        fence.close()
 
 
 if __name__ == '__main__':
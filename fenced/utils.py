@@ -1,23 +1,29 @@
 from logging import getLogger
-from os import DirEntry, scandir
-from re import compile as re_compile
+from os import listdir
 
 logger = getLogger(__name__)
 
-SD_PATTERN = re_compile(r"^sd[a-z]+$")
-NVME_PATTERN = re_compile(r"^nvme\d+n\d+$")
 
-
-def should_not_ignore(entry: DirEntry, ed: tuple[str] | tuple) -> bool:
+def should_not_ignore(name: str, ed: frozenset[str]) -> bool:
     """Returns true if the device should NOT be ignored, false otherwise"""
-    if entry.name in ed:
+    # most of /dev isn't disks so check the name first and only
+    # then whether it has been excluded
+    if not name.isascii():
+        return False
+    elif name.startswith("sd"):
+        # sda, sdb, ..., sdaa, etc (but not partitions)
+        is_disk = name[2:].isalpha() and name[2:].islower()
+    elif name.startswith("nvme"):
+        # nvme namespaces (nvme0n1), not the controllers (nvme0),
+        # the multipath devices (nvme0c0n1) or partitions (nvme0n1p1)
+        ctrl, sep, ns = name[4:].partition("n")
+        is_disk = bool(sep) and ctrl.isdigit() and ns.isdigit()
+    else:
         return False
-    elif SD_PATTERN.match(entry.name) or NVME_PATTERN.match(entry.name):
-        return True
-    return False
+    return is_disk and name not in ed
 
 
-def load_disks_from_dev(ed: tuple[str] | tuple) -> dict[str, str]:
+def load_disks_from_dev(ed: frozenset[str]) -> dict[str, str]:
     """Iterating over /dev is the safest route for getting a list of
     disks. One, non-obvious, reason for using /dev/ is that our HA
     systems will mount disks between the nodes across the heartbeat
@@ -27,16 +33,18 @@ def load_disks_from_dev(ed: tuple[str] | tuple) -> dict[str, str]:
     risk of enumerating those devices and breaking fenced."""
     disks = {}
     try:
-        with scandir("/dev") as sdir:
-            for disk in filter(lambda x: should_not_ignore(x, ed), sdir):
-                disks[disk.name] = disk.name
-    except Exception:
-        logger.error("Unhandled exception enumerating disks", exc_info=True)
+        # we only ever look at the names so there is no need for the
+        # DirEntry objects scandir would create for every entry
+        for name in listdir("/dev"):
+            if should_not_ignore(name, ed):
+                disks[name] = name
+    except OSError:
+        logger.error("Failed to enumerate disks", exc_info=True)
 
     return disks
 
 
-def load_disks_impl(ed: tuple[str] | tuple, use_zpools: bool = False) -> dict[str, str]:
+def load_disks_impl(ed: frozenset[str], use_zpools: bool = False) -> dict[str, str]:
     """
     Return disk(s) to have persistent reservations placed upon.
         `ed`: user supplied disk(s) that will be excluded from having
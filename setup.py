@@ -1,11 +1,11 @@
-from setuptools import find_packages, setup
+from setuptools import setup
 
 
 setup(
     name='fenced',
     version='0.0.3',
     description='TrueNAS SCALE Fencing Daemon',
-    packages=find_packages(),
+    packages=['fenced'],
     classifiers=[
         'Programming Language :: Python :: 3',
     ],